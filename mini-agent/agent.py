@@ -1,25 +1,73 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import shlex
+import asyncio
+import importlib
 import threading
+from types import SimpleNamespace
+from collections import deque
 from pathlib import Path
 from datetime import datetime
 
 from prompt_toolkit import Application
 from prompt_toolkit.application import get_app
+from prompt_toolkit.document import Document
 from prompt_toolkit.layout import Layout, HSplit, VSplit
-from prompt_toolkit.layout.containers import Window
 from prompt_toolkit.layout.dimension import Dimension as D
 from prompt_toolkit.widgets import TextArea, RadioList, Frame
 from prompt_toolkit.key_binding import KeyBindings
+from prompt_toolkit.formatted_text import to_formatted_text
+from prompt_toolkit.mouse_events import MouseEventType
+from prompt_toolkit.filters import Condition, to_filter
+from prompt_toolkit.layout.margins import ConditionalMargin, ScrollbarMargin
 
 from skills import SkillManager
+from sessions import Session
+
+# Log区域最多保留的行数:
+LOG_MAX_LINES = 2000
+# 合并刷新Log的间隔(秒):
+LOG_FLUSH_DELAY = 0.04
+
+# 创建Application时才导入的模块, 启动时在后台预先导入:
+_PREWARM_MODULES = (
+    'prompt_toolkit.input.vt100',
+    'prompt_toolkit.key_binding.bindings.search',
+    'prompt_toolkit.patch_stdout',
+)
+
+class _TaskScrollbarMargin(ScrollbarMargin):
+    '''按整个列表而不是当前生成的可见条目绘制滚动条'''
+    def __init__(self, radio_list, **kwargs):
+        super().__init__(**kwargs)
+        self.radio_list = radio_list
+
+    def create_margin(self, window_render_info, width, height):
+        total = len(self.radio_list.values)
+        info = SimpleNamespace(
+            content_height=total,
+            window_height=window_render_info.window_height,
+            displayed_lines=range(min(total, window_render_info.window_height)),
+            vertical_scroll=self.radio_list._offset,
+        )
+        return super().create_margin(info, width, height)
 
 class MyRadioList(RadioList):
     def __init__(self, *args, on_change=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.on_change = on_change
+        # 第一个可见条目的索引:
+        self._offset = 0
+        # 窗口占满所在面板, 其高度即可见行数, 与生成的条目数无关:
+        self.window.dont_extend_height = to_filter(False)
+        self.window.right_margins = [
+            ConditionalMargin(
+                margin=_TaskScrollbarMargin(self, display_arrows=True),
+                filter=Condition(lambda: self.show_scrollbar),
+            ),
+        ]
 
     def _handle_enter(self):
         # RadioList 原本的回车逻辑是选中并返回
@@ -28,34 +76,67 @@ class MyRadioList(RadioList):
         if self.on_change:
             self.on_change(self.current_value)
 
+    def _get_text_fragments(self):
+        # 只生成窗口可见的条目, 条目很多时无需布局全部行,
+        # 可见范围跟随选中项移动. 首次渲染前窗口高度未知, 按终端行数估计:
+        render_info = self.window.render_info
+        if render_info is not None:
+            rows = max(1, render_info.window_height)
+        else:
+            rows = max(1, get_app().output.get_size().rows)
+        if self._selected_index < self._offset:
+            self._offset = self._selected_index
+        elif self._selected_index >= self._offset + rows:
+            self._offset = self._selected_index - rows + 1
+
+        def mouse_handler(mouse_event):
+            if mouse_event.event_type == MouseEventType.MOUSE_UP:
+                self._selected_index = self._offset + mouse_event.position.y
+                self._handle_enter()
+
+        result = []
+        for i in range(self._offset, min(len(self.values), self._offset + rows)):
+            value, label = self.values[i]
+            checked = value == self.current_value
+            selected = i == self._selected_index
+            style = ''
+            if checked:
+                style += ' ' + self.checked_style
+            if selected:
+                style += ' ' + self.selected_style
+            result.append((style, self.open_character))
+            if selected:
+                result.append(('[SetCursorPosition]', ''))
+            result.append((style, self.select_character if checked else ' '))
+            result.append((style, self.close_character))
+            result.append((f'{style} {self.default_style}', ' '))
+            result.extend(to_formatted_text(label, style=f'{style} {self.default_style}'))
+            result.append(('', '\n'))
+        result.pop() # 去掉最后的换行
+        return [(style, text, mouse_handler) for style, text, *_ in result]
+
 class MiniAgent:
     def __init__(self, workspace: Path = None):
         # 路径初始化:
         self.pwd = Path(__file__).resolve().parent
         self.workspace = workspace or Path("~/.mini-agent-workspace").expanduser()
         self.skills_path = self.pwd.parent / "skills"
+        self.sessions_path = self.workspace / "sessions"
         self.workspace.mkdir(exist_ok=True)
+        self.sessions_path.mkdir(exist_ok=True)
 
         # 组件初始化
-        self.skill_manager = SkillManager(self.skills_path)
+        self.skill_manager = SkillManager(self.skills_path, self.workspace / "skill_cache")
+        threading.Thread(target=self._prewarm, daemon=True).start()
         #self.session_manager = SessionManager(self.workspace)
         self.current_session = None
 
         # TUI 组件
         self.task_list = MyRadioList(values=[
             ("task-0", "默认：聊天"),
-            ("task-1", "📝 任务: 修复Bug"),
-            ("task-2", "🚀 任务: 部署xxx环境"),
-            ("task-3", "📝 任务: 修复Bug"),
-            ("task-4", "🚀 任务: 部署xxx环境"),
-            ("task-5", "📝 任务: 修复Bug"),
-            ("task-6", "🚀 任务: 部署xxx环境"),
-            ("task-7", "📝 任务: 修复Bug"),
-            ("task-8", "🚀 任务: 部署xxx环境"),
-            ("task-9", "📝 任务: 修复Bug"),
-        ], on_change=self.on_task_changed)
-
-        self.output_field = TextArea(text=r'''
+        ] + self._load_tasks(), on_change=self.on_task_changed)
+
+        banner = r'''
         _       _     _                    _
   /\/\ (_)_ __ (_)   /_\   __ _  ___ _ __ | |_
  /    \| | '_ \| |  //_\\ / _` |/ _ \ '_ \| __|
@@ -63,7 +144,11 @@ class MiniAgent:
 \/    \/_|_| |_|_| \_/ \_/\__, |\___|_| |_|\__|
                           |___/
 version 0.1
-''' + 'Type /help for commands.\n', read_only=True, scrollbar=True)
+''' + 'Type /help for commands.\n'
+        self._log_lines = deque(banner.split('\n')[:-1], maxlen=LOG_MAX_LINES)
+        self._pending_lines = []
+        self._flush_scheduled = False
+        self.output_field = TextArea(text=banner, read_only=True, scrollbar=True)
         self.input_field = TextArea(prompt="> ", multiline=True)
         self.kb = KeyBindings()
         
@@ -80,38 +165,65 @@ version 0.1
             if not raw_input:
                 return
 
-            try:
-                parts = shlex.split(raw_input)
-                cmd = parts[0].lower()
-                args = parts[1:]
-
-                # --- 路由逻辑 ---
-                if cmd in ['/exit', '/quit', '/q']:
-                    self._handle_exit()
-                    event.app.exit()
-                elif cmd in ['/help', '/h']:
-                    self.append_log("Commands: status, new <task>, pause, stop, help")
-                elif cmd in ['/status', '/st']:
-                    self._cmd_status()
-                elif cmd == 'new':
-                    if args: self._cmd_new(args[0])
-                    else: self.append_log("Usage: new <task_name>")
-                elif cmd in ['/stop', '/s']:
-                    self._cmd_stop()
-                elif cmd in ['/pause', '/p']:
-                    self._cmd_pause()
-                else:
-                    # 如果不是内置命令，则作为对话处理
-                    self._handle_chat(raw_input)
+            # 非内置命令直接作为对话处理, 无需shlex解析:
+            handler = _DISPATCH.get(raw_input.split(maxsplit=1)[0].lower())
+            if handler is None:
+                self._handle_chat(raw_input)
+                return
 
+            try:
+                args = shlex.split(raw_input)[1:]
+                handler(self, *args)
             except Exception as e:
                 self.append_log(f"Error: {str(e)}")
 
+    def _list_sessions(self) -> list:
+        '''按时间倒序返回sessions目录下的session id'''
+        # DirEntry.is_dir()可直接使用目录项类型, 无需逐个stat:
+        with os.scandir(self.sessions_path) as it:
+            return sorted((e.name for e in it if e.is_dir()), reverse=True)
+
+    def _load_tasks(self) -> list:
+        '''按时间倒序列出sessions目录下的任务'''
+        return [(sid, f"📝 任务: {sid}") for sid in self._list_sessions()]
+
+    def _prewarm(self):
+        '''后台预热: 导入延迟加载的模块, 不阻塞首次渲染'''
+        for name in _PREWARM_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
     def append_log(self, text: str):
-        '''向滚动区域追加文本并滚动到底部'''
-        self.output_field.text += f"{text}\n"
-        # 自动滚动到底部
-        self.output_field.buffer.cursor_position = len(self.output_field.text)
+        '''向滚动区域追加文本, 短时间内的多次追加合并为一次刷新'''
+        self._pending_lines.append(text)
+        if self._flush_scheduled:
+            return
+        app = get_app()
+        if not app.is_running:
+            self._flush_log()
+            return
+        self._flush_scheduled = True
+        app.loop.call_later(LOG_FLUSH_DELAY, self._flush_log)
+
+    def _flush_log(self):
+        '''将待追加的文本写入滚动区域并滚动到底部'''
+        text = '\n'.join(self._pending_lines)
+        self._pending_lines.clear()
+        self._flush_scheduled = False
+        lines = text.split('\n')
+        buffer = self.output_field.buffer
+        trimmed = len(self._log_lines) + len(lines) > LOG_MAX_LINES
+        self._log_lines.extend(lines)
+        if trimmed:
+            # 超出上限, deque已丢弃最早的行, 重建文本:
+            new_text = '\n'.join(self._log_lines) + '\n'
+        else:
+            new_text = buffer.text + text + '\n'
+        # 光标置于末尾即自动滚动到底部:
+        buffer.set_document(Document(new_text, len(new_text)), bypass_readonly=True)
+        get_app().invalidate()
 
     # --- 命令实现函数 ---
     def on_task_changed(self, value):
@@ -121,7 +233,18 @@ version 0.1
         if selected_label:
             self.append_log(f"\n[🔍 已选中任务]: {selected_label} (ID: {value})")
 
-    def _cmd_new(self, task_name: str):
+    def _cmd_exit(self, *args):
+        self._handle_exit()
+        get_app().exit()
+
+    def _cmd_help(self, *args):
+        self.append_log("Commands: status, new <task>, pause, stop, help")
+
+    def _cmd_new(self, *args):
+        if not args:
+            self.append_log("Usage: new <task_name>")
+            return
+        task_name = args[0]
         date_str = datetime.now().strftime("%Y-%m-%d")
         session_id = f"{date_str}-{task_name}"
         # 这里实例化你写的 Session 类
@@ -129,15 +252,18 @@ version 0.1
         self.append_log(f"[*] Started new task: {session_id}")
         self.input_field.prompt = f"[{task_name}] >>> "
 
-    def _cmd_status(self):
+    def _cmd_status(self, *args):
         self.append_log(f"{'Session ID':<30} | {'Status':<10}")
         self.append_log("-" * 45)
-        for p in sorted(self.sessions_path.iterdir(), reverse=True):
-            if p.is_dir():
-                # 简单读取 meta.json
-                self.append_log(f"{p.name:<30} | ...") 
+        for sid in self._list_sessions():
+            # 只读打开, 仅读取 meta.json, 读取失败不影响其他session:
+            try:
+                status = Session(self.sessions_path / sid, readonly=True).get_meta()['status']
+            except (OSError, ValueError, TypeError):
+                status = '...'
+            self.append_log(f"{sid:<30} | {status:<10}")
 
-    def _cmd_stop(self):
+    def _cmd_stop(self, *args):
         if self.current_session:
             sid = self.current_session.session_id
             # self.current_session.set_status('failed')
@@ -148,21 +274,56 @@ version 0.1
         else:
             self.append_log("No active task to stop.")
 
+    def _cmd_pause(self, *args):
+        if self.current_session:
+            # self.current_session.set_status('paused')
+            # self.current_session.save()
+            self.append_log(f"[!] Task {self.current_session.session_id} paused.")
+        else:
+            self.append_log("No active task to pause.")
+
     def _handle_chat(self, text: str):
         if not self.current_session:
             self.append_log("[!] No active session. Use 'new <task>' first.")
             #return
         self.append_log(f"👤: {text}")
 
-        # 后台线程调用LLM:
-        loop = get_app().loop
+        # 在事件循环中后台执行, 结果直接在UI线程更新:
+        get_app().create_background_task(self._run_chat(text))
+
+    async def _run_chat(self, text: str):
+        # 阻塞的LLM调用放到守护线程执行, 退出程序时不会等待它结束:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _resolve(setter, value):
+            # 任务可能已随程序退出被取消:
+            if not future.done():
+                setter(value)
+
         def _background_task():
-            import time
-            time.sleep(2)
-            result = 'hehe, it is ok!'
-            # 拿到结果后, UI线程负责更新:
-            loop.call_soon_threadsafe(self._finalize_chat, result)
+            try:
+                args = (future.set_result, self._call_llm(text))
+            except Exception as e:
+                args = (future.set_exception, e)
+            try:
+                loop.call_soon_threadsafe(_resolve, *args)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
         threading.Thread(target=_background_task, daemon=True).start()
+        try:
+            result = await future
+        except Exception as e:
+            self.append_log(f"Error: {str(e)}")
+            return
+        self._finalize_chat(result)
+
+    def _call_llm(self, text: str) -> str:
+        import time
+        time.sleep(2)
+        return 'hehe, it is ok!'
 
     def _finalize_chat(self, result):
         self.append_log(f"💻: {result}")
@@ -173,18 +334,11 @@ version 0.1
             pass
 
     def run(self):
-        # 关键修复：使用HSplit包装RadioList，添加填充占满高度
-        task_container = HSplit([
-            # RadioList 内容
-            self.task_list,
-            # 填充容器：占满剩余所有空间
-            Window(height=D(weight=1))
-        ])
         upper_layout = VSplit([
             Frame(self.output_field, title='Log', height=D(weight=1)),
-            # 右侧Tasks面板：使用包装后的容器，确保占满高度
+            # 右侧Tasks面板：任务列表自身占满高度
             Frame(
-                task_container,
+                self.task_list,
                 title='Tasks',
                 width=25,
                 height=D(weight=1)
@@ -198,6 +352,22 @@ version 0.1
         app = Application(layout=layout, key_bindings=self.kb, full_screen=True)
         app.run()
 
+# 内置命令分派表, 其他输入均作为对话处理:
+_DISPATCH = {
+    '/exit': MiniAgent._cmd_exit,
+    '/quit': MiniAgent._cmd_exit,
+    '/q': MiniAgent._cmd_exit,
+    '/help': MiniAgent._cmd_help,
+    '/h': MiniAgent._cmd_help,
+    '/status': MiniAgent._cmd_status,
+    '/st': MiniAgent._cmd_status,
+    'new': MiniAgent._cmd_new,
+    '/stop': MiniAgent._cmd_stop,
+    '/s': MiniAgent._cmd_stop,
+    '/pause': MiniAgent._cmd_pause,
+    '/p': MiniAgent._cmd_pause,
+}
+
 if __name__ == '__main__':
     agent = MiniAgent()
     agent.run()
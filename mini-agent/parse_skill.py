@@ -22,6 +22,11 @@ SKILL.md必须包含description和usage描述。
 import re
 from pathlib import Path
 
+# 预编译正则:
+_TITLE_RE = re.compile(r'(?m)^(#{1,5}\s+.+)$')
+_PLACEHOLDER_RE = re.compile(r'\{(\w+?)\}')
+_ARG_RE = re.compile(r'\s*\-\s*(\w+)\s*:\s*(.*)')
+
 def parse_skill(skill_path: Path) -> dict:
     '''
     读取skill_dir目录的SKILL.md并解析skill
@@ -36,9 +41,7 @@ def parse_skill(skill_path: Path) -> dict:
     >>> skill['function']['parameters']['required']
     ['input_format', 'output_format', 'output_file', 'input_file']
     '''
-    skill_md = skill_path / 'SKILL.md'
-    with open(skill_md, 'r', encoding='utf-8') as f:
-        md_content = f.read()
+    md_content = (skill_path / 'SKILL.md').read_text(encoding='utf-8')
     sections = split_markdown_by_titles(md_content)
     if 'usage' not in sections:
         raise ValueError('No usage found in SKILL.md')
@@ -64,20 +67,17 @@ def split_markdown_by_titles(md_content: str) -> dict:
     'Copyright@2026\\nhttps://mini-agent.puppylab.org'
     >>> 'reference' in blocks
     False
+    >>> split_markdown_by_titles('preface\\n# A\\nbody\\n## B')
+    {'a': 'body', 'b': ''}
     '''
-    pattern = r'(?m)^(#{1,5}\s+.+)$'
-    parts = re.split(pattern, md_content)
-    # parts 的第一个元素可能是标题前的空内容，先剔除
-    if parts and not parts[0].strip():
-        parts.pop(0)
+    matches = list(_TITLE_RE.finditer(md_content))
     sections = {}
-    # 步长为2遍历：parts[i]是标题，parts[i+1]是内容
-    for i in range(0, len(parts), 2):
-        if i + 1 < len(parts):
-            # 去掉标题开头的 # 号并清理空白
-            title = re.sub(r'^#{1,5}\s+', '', parts[i]).strip().lower()
-            content = parts[i+1].strip()
-            sections[title] = content
+    # 按相邻标题的位置切分原文, 标题前的内容忽略:
+    for i, m in enumerate(matches):
+        end = matches[i+1].start() if i + 1 < len(matches) else len(md_content)
+        # 去掉标题开头的 # 号并清理空白
+        title = m.group(1).lstrip('#').strip().lower()
+        sections[title] = md_content[m.end():end].strip()
     return sections
 
 def parse_description(description: str) -> str:
@@ -111,6 +111,8 @@ def parse_usage(usage: str) -> dict:
     Traceback (most recent call last):
         ...
     ValueError: Missing description for parameter: input_file
+    >>> parse_usage('cp {src} {src}.bak\\n- src: the source file')['function']['parameters']['required']
+    ['src']
     '''
     # 清理空行并拆分:
     lines = [line.strip() for line in usage.split('\n') if line.strip()]
@@ -121,25 +123,28 @@ def parse_usage(usage: str) -> dict:
     command_template = lines[0]
 
     # 找出模板中所有的占位符, 如{input_file}:
-    placeholders = re.findall(r'\{(\w+?)\}', command_template)
+    placeholders = _PLACEHOLDER_RE.findall(command_template)
+    # 去重并保持顺序, 同时用set做成员判断:
+    ordered = list(dict.fromkeys(placeholders))
+    ph_set = set(ordered)
     
     # 解析参数描述, 格式为: - key: description
     arg_descriptions = {}
     for line in lines[1:]:
-        match = re.match(r'\s*\-\s*(\w+)\s*:\s*(.*)', line)
+        match = _ARG_RE.match(line)
         if match:
             key, desc = match.groups()
             arg_descriptions[key.strip()] = desc.strip()
 
     # 校验：确保每个占位符都有对应的描述
-    for p in placeholders:
+    for p in ordered:
         if p not in arg_descriptions:
             raise ValueError(f'Missing description for parameter: {p}')
 
     # 构造LLM tool_call:
     properties = {
         key: {'type': 'string', 'description': desc}
-        for key, desc in arg_descriptions.items() if key in placeholders
+        for key, desc in arg_descriptions.items() if key in ph_set
     }
 
     return {
@@ -149,7 +154,7 @@ def parse_usage(usage: str) -> dict:
             'parameters': {
                 'type': 'object',
                 'properties': properties,
-                'required': placeholders
+                'required': ordered
             }
         }
     }
@@ -1,29 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import json
+import time
+import functools
 import logging
 from datetime import datetime
 
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # task运行的状态:
 RUNNING = 'running'
 PAUSED = 'paused'
 SUCCESS = 'success'
 FAILED = 'failed'
 
+def _dumps(obj, indent: bool = False) -> bytes:
+    '''序列化为UTF-8编码的JSON, 安装了orjson时优先使用orjson'''
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+@functools.lru_cache(maxsize=256)
+def _load_meta(path_str: str, mtime_ns: int) -> dict:
+    '''读取meta.json, 按(路径, 修改时间)缓存, 调用方不得修改返回的dict'''
+    with open(path_str, 'rb') as f:
+        return _loads(f.read())
+
 class Session:
-    def __init__(self, session_path: Path):
+    def __init__(self, session_path: Path, readonly: bool = False):
         self.session_path = session_path
         self.session_id = session_path.name
+        self._readonly = readonly
         
         # 定义内部文件路径
         self._meta_path = session_path.joinpath('meta.json')
-        self._history_path = session_path.joinpath('history.json')
+        self._history_path = session_path.joinpath('history.jsonl')
         self._log_path = session_path.joinpath('session.log')
         
         # 初始化内部状态
+        self._now_ts = None
+        self._now_str = None
         now = self._now()
         self._meta = {
             'name': 'unnamed',
@@ -33,19 +60,27 @@ class Session:
             'created_at': now,
             'last_active': now
         }
-        if self._meta_path.exists():
-            with open(self._meta_path, 'r', encoding='utf-8') as f:
-                self._meta.update(json.load(f))
+        try:
+            st = os.stat(self._meta_path)
+        except FileNotFoundError:
+            pass
+        else:
+            self._meta.update(_load_meta(str(self._meta_path), st.st_mtime_ns))
 
         self._history = None
         
+        # 只读模式(如查看状态)不需要日志记录器:
+        self._logger = None
+        if readonly:
+            return
+
         # 初始化日志记录器
         self._logger = logging.getLogger(self.session_id)
         self._logger.setLevel(logging.INFO)
         
         # 防止重复添加 handler
         if not self._logger.handlers:
-            fh = logging.FileHandler(self._log_path, encoding='utf-8')
+            fh = logging.FileHandler(self._log_path, encoding='utf-8', delay=True)
             formatter = logging.Formatter('---------- %(asctime)s - %(levelname)s ----------\n%(message)s\n')
             fh.setFormatter(formatter)
             self._logger.addHandler(fh)
@@ -54,32 +89,66 @@ class Session:
         return self._meta
 
     def get_history(self) -> list:
+        '''
+        读取history.jsonl, 没有换行结尾的末行视为追加时中断留下的不完整记录并丢弃.
+
+        >>> import tempfile
+        >>> s = Session(Path(tempfile.mkdtemp()))
+        >>> _ = s._history_path.write_bytes(b'{"role":"user","content":"a"}\\n{"role":"user","content":"b"}')
+        >>> s.get_history()
+        [{'role': 'user', 'content': 'a'}]
+        >>> s.add_message('assistant', 'c')
+        >>> Session(s.session_path).get_history()
+        [{'role': 'user', 'content': 'a'}, {'role': 'assistant', 'content': 'c'}]
+        '''
         if self._history is None:
+            self._history = []
             if self._history_path.exists():
-                with open(self._history_path, 'r', encoding='utf-8') as f:
-                    self._history = json.load(f)
-            else:
-                self._history = []
+                data = self._history_path.read_bytes()
+                valid_size = data.rfind(b'\n') + 1
+                # 每行一条消息:
+                self._history = [_loads(line) for line in data[:valid_size].splitlines() if line.strip()]
+                if valid_size != len(data) and not self._readonly:
+                    # 截掉不完整的末行, 避免后续追加的消息与其连在一起:
+                    os.truncate(self._history_path, valid_size)
         return self._history
 
-    def save(self):
-        '''持久化 meta 和 history'''
+    def save(self, compact: bool = False):
+        '''持久化 meta, history已在add_message时追加写入, compact=True时整体重写history'''
+        self._check_writable()
         self._meta['last_active'] = self._now()
         
         # 写入 meta.json
-        with open(self._meta_path, 'w', encoding='utf-8') as f:
-            json.dump(self._meta, f, indent=2, ensure_ascii=False)    
-        # 写入 history.json
-        with open(self._history_path, 'w', encoding='utf-8') as f:
-            json.dump(self._history, f, indent=2, ensure_ascii=False)
+        self._meta_path.write_bytes(_dumps(self._meta, indent=True))
+        # 重写 history.jsonl
+        if compact:
+            # 先写临时文件再替换, 避免中断时丢失原有history:
+            tmp_path = self._history_path.with_name(self._history_path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                for message in self.get_history():
+                    f.write(_dumps(message) + b'\n')
+            os.replace(tmp_path, self._history_path)
 
         self._log(f'Session state saved to {self.session_path}', logging.DEBUG)
 
     def add_message(self, role: str, content: str, failure: bool = False, **kwargs):
-        '''添加对话条目'''
+        '''
+        添加对话条目, 只读session不允许写入.
+
+        >>> import tempfile
+        >>> s = Session(Path(tempfile.mkdtemp()), readonly=True)
+        >>> s.add_message('user', 'hi') # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ValueError: Session ... is read-only
+        '''
+        self._check_writable()
         message = {'role': role, 'content': content}
         message.update(kwargs) # 处理 tool_call_id 等扩展字段
-        self._history.append(message)
+        self.get_history().append(message)
+        # 追加写入 history.jsonl
+        with open(self._history_path, 'ab') as f:
+            f.write(_dumps(message) + b'\n')
         
         if role == 'assistant':
             self._meta['steps'] += 1
@@ -87,11 +156,23 @@ class Session:
             self._meta['failures'] += 1
         self._log(f'Added message from {role}')
 
+    def _check_writable(self):
+        if self._readonly:
+            raise ValueError(f'Session {self.session_id} is read-only')
+
     def _log(self, message: str, level: int = logging.INFO):
         '''记录日志到 session.log'''
-        self._logger.log(level, message)
+        if self._logger is not None:
+            self._logger.log(level, message)
 
     def _now(self) -> str:
-        now = datetime.now()
-        now.microsecond = 0
-        return now.isoformat()
+        # 精确到秒, 同一秒内复用已格式化的字符串:
+        ts = int(time.time())
+        if ts != self._now_ts:
+            self._now_ts = ts
+            self._now_str = datetime.fromtimestamp(ts).isoformat()
+        return self._now_str
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import json
+import string
+import hashlib
+import tempfile
+import threading
 import subprocess
 from pathlib import Path
+from collections import deque
 
 from parse_skill import parse_skill
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# exec_command返回的最大输出行数:
+EXEC_OUTPUT_MAX_LINES = 2000
+
+# Skill缓存格式版本, parse_skill的输出变化时必须递增:
+_CACHE_VERSION = 1
+
 # 内置Skill: 读取文件内容
 def read_file(**kw):
     if 'file_path' not in kw:
@@ -31,13 +48,56 @@ def exec_command(**kw):
     if 'command' not in kw:
         raise ValueError('Missing parameter: command')
     command = kw['command']
-    result = subprocess.run(command, shell=True, capture_output=True, text=True, encoding='utf-8')
-    exit_code = result.returncode
-    stdout = result.stdout
-    stderr = result.stderr
+    # 合并stdout和stderr逐行读取, 只保留最后EXEC_OUTPUT_MAX_LINES行:
+    with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, encoding='utf-8', errors='replace', bufsize=1) as proc:
+        output = deque(proc.stdout, maxlen=EXEC_OUTPUT_MAX_LINES)
+    exit_code = proc.returncode
     if exit_code != 0:
-        return f'Error {exit_code}:\n{stdout}\n{stderror}'
-    return f'{stdout}\n{stderror}'
+        return f'Error {exit_code}:\n' + ''.join(output)
+    return ''.join(output)
+
+# 模板字段的转换标记, 如{x!r}:
+_CONVERSIONS = {'r': repr, 's': str, 'a': ascii}
+
+def compile_template(templ: str) -> callable:
+    '''
+    预先解析命令模板, 返回的函数执行时只做拼接, 效果等同于templ.format(**kw).
+
+    >>> render = compile_template("echo '{words}' {{done}}")
+    >>> render(words='Hello')
+    "echo 'Hello' {done}"
+    >>> compile_template('echo {x!r}')(x='a b')
+    "echo 'a b'"
+
+    含索引、属性访问或嵌套格式的字段直接使用str.format:
+
+    >>> compile_template('{a[0]} {b.real} {c:>{w}}')(a='xy', b=3, c='z', w=3)
+    'x 3   z'
+    '''
+    parts = list(string.Formatter().parse(templ))
+    if any(field is not None and (not field.isidentifier() or '{' in spec)
+           for _, field, spec, _ in parts):
+        return lambda **kw: templ.format(**kw)
+    def render(**kw):
+        buf = []
+        for literal, field, spec, conversion in parts:
+            buf.append(literal)
+            if field is not None:
+                value = kw[field]
+                if conversion:
+                    value = _CONVERSIONS[conversion](value)
+                buf.append(format(value, spec))
+        return ''.join(buf)
+    return render
+
+# 定义动态Skill闭包执行函数:
+def make_run_skill(templ: str) -> callable:
+    render = compile_template(templ)
+    def run_skill(**kw):
+        command = render(**kw)
+        return exec_command(command=command)
+    return run_skill
 
 class Skill:
     def __init__(self, name: str, description: str, tool_call: dict, func: callable):
@@ -49,38 +109,119 @@ class Skill:
     def __str__(self):
         return f'Skill: {self.name}: {self.description}'
 
+def load_skill(skill_path: Path, cache_path: Path = None) -> dict:
+    '''
+    解析skill_path目录的SKILL.md, 如果指定了cache_path则优先读取缓存.
+
+    缓存文件名由缓存版本及SKILL.md的路径、修改时间和大小计算得到, 文件修改后自动失效,
+    写缓存失败时忽略, 仍返回解析结果.
+
+    >>> import tempfile
+    >>> cache_path = Path(tempfile.mkdtemp())
+    >>> skill = load_skill(Path('../skills/hello_world'), cache_path)
+    >>> len(list(cache_path.glob('*.json')))
+    1
+    >>> load_skill(Path('../skills/hello_world'), cache_path) == skill
+    True
+    >>> not_a_dir = next(cache_path.glob('*.json')) / 'sub'
+    >>> load_skill(Path('../skills/hello_world'), not_a_dir) == skill
+    True
+    '''
+    if cache_path is None:
+        return parse_skill(skill_path)
+    st = (skill_path / 'SKILL.md').stat()
+    key_src = f'{_CACHE_VERSION}:{skill_path}:{st.st_mtime_ns}:{st.st_size}'
+    key = hashlib.blake2b(key_src.encode()).digest()[:16].hex()
+    cache_file = cache_path / f'{key}.json'
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    skill = parse_skill(skill_path)
+    # 先写临时文件再替换, 避免并发读到不完整的缓存:
+    # 临时文件名唯一, 多个线程或进程同时写同一缓存也不会互相覆盖:
+    tmp_file = None
+    try:
+        cache_path.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_path,
+                                         prefix=f'{key}.', suffix='.tmp', delete=False) as f:
+            tmp_file = f.name
+            json.dump(skill, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # 磁盘已满或目录只读时不使用缓存:
+        if tmp_file is not None:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+    return skill
+
+class _LazySkillStub:
+    '''
+    尚未解析的Skill, 仅记录SKILL.md所在目录, 首次使用时才解析.
+    '''
+    def __init__(self, skill_path: Path):
+        self.name = skill_path.name
+        self.skill_path = skill_path
+
+    def __str__(self):
+        return f'Skill: {self.name}: (not loaded)'
+
 class SkillManager:
     '''
     SkillManager用于加载和管理Agent的Skill.
 
     >>> sm = SkillManager(Path('../skills').resolve()) # doctest: +ELLIPSIS
-    skill "file_format_convert" loaded: ...
-    skill "hello_world" loaded: ...
+    skill "file_format_convert" found: ...
+    skill "hello_world" found: ...
+    skill "read_file" loaded: ...
+    skill "write_file" loaded: ...
+    skill "exec_command" loaded: ...
+    >>> sm.get_tool_calls() # doctest: +ELLIPSIS
+    '[{"type":...}]'
+    >>> sm.get_tool_calls() is sm.get_tool_calls()
+    True
+    >>> print(sm._get_skill('hello_world'))
+    Skill: hello_world: Say hello to someone.
+
+    无法解析的SKILL.md只移除对应的Skill:
+
+    >>> import shutil, tempfile
+    >>> skills_path = Path(tempfile.mkdtemp())
+    >>> _ = shutil.copytree(Path('../skills/hello_world'), skills_path / 'hello_world')
+    >>> (skills_path / 'broken').mkdir()
+    >>> _ = (skills_path / 'broken' / 'SKILL.md').write_text('# Broken\\n', encoding='utf-8')
+    >>> sm = SkillManager(skills_path) # doctest: +ELLIPSIS
+    skill "broken" found: ...
+    skill "hello_world" found: ...
     skill "read_file" loaded: ...
     skill "write_file" loaded: ...
     skill "exec_command" loaded: ...
     >>> sm.get_tool_calls() # doctest: +ELLIPSIS
-    '[{"type": "function", "function": {...}]'
+    skill "broken" removed: No usage found in SKILL.md
+    '[{"type":...hello_world...}]'
+    >>> 'broken' in sm._skills
+    False
     '''
 
-    def __init__(self, skills_path: Path):
+    def __init__(self, skills_path: Path, cache_path: Path = None):
+        # name -> Skill或尚未解析的_LazySkillStub:
         self._skills = {}
+        self._cache_path = cache_path
+        # get_tool_calls()的结果缓存, 注册新Skill时失效:
+        self._tool_calls_json = None
+        # 解析Skill可能同时发生在UI线程和后台预热线程:
+        self._lock = threading.RLock()
         # 扫描skills目录:
-        for entry in sorted(skills_path.iterdir()):
-            if not entry.is_dir():
-                continue
-            skill_md = entry / 'SKILL.md'
-            if not skill_md.exists():
+        # DirEntry.is_dir()可直接使用目录项类型, 无需逐个stat:
+        with os.scandir(skills_path) as it:
+            entries = sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+        for entry in entries:
+            if not os.path.isfile(os.path.join(entry.path, 'SKILL.md')):
                 continue
-            skill_tool_call = parse_skill(entry)
-            template = skill_tool_call.pop('template')
-            # 定义动态Skill闭包执行函数:
-            def make_run_skill(templ):
-                def run_skill(**kw):
-                    command = templ.format(**kw)
-                    return exec_command(command=command)
-                return run_skill
-            self._register_skill(skill_tool_call, make_run_skill(template))
+            self._register_lazy_skill(Path(entry.path))
         # 加载内置Skill:
         read_file_tool_call = {
             'type': 'function',
@@ -147,8 +288,41 @@ class SkillManager:
         if name in self._skills:
             raise ValueError(f'Duplicate skill: {name}')
         self._skills[name] = Skill(name, description, skill_tool_call, func)
+        self._tool_calls_json = None
         print(f'skill "{name}" loaded: {description}')
 
+    def _register_lazy_skill(self, skill_path: Path):
+        name = skill_path.name
+        if name in self._skills:
+            raise ValueError(f'Duplicate skill: {name}')
+        self._skills[name] = _LazySkillStub(skill_path)
+        self._tool_calls_json = None
+        print(f'skill "{name}" found: {skill_path}')
+
+    def _get_skill(self, name: str) -> Skill:
+        with self._lock:
+            return self._resolve_skill(name)
+
+    def _resolve_skill(self, name: str) -> Skill:
+        # 在锁内检查, 后台线程可能刚移除了解析失败的Skill:
+        if name not in self._skills:
+            raise ValueError(f'Skill {name} not found.')
+        skill = self._skills[name]
+        if isinstance(skill, _LazySkillStub):
+            # 首次使用时解析SKILL.md并替换, 解析失败则移除该Skill:
+            try:
+                skill_tool_call = load_skill(skill.skill_path, self._cache_path)
+            except (OSError, ValueError) as e:
+                del self._skills[name]
+                self._tool_calls_json = None
+                print(f'skill "{name}" removed: {e}')
+                raise
+            template = skill_tool_call.pop('template')
+            description = skill_tool_call['function']['description']
+            skill = Skill(name, description, skill_tool_call, make_run_skill(template))
+            self._skills[name] = skill
+        return skill
+
     def run_skill(self, tool_call: object) -> str:
         try:
             result = self._run_skill(tool_call)
@@ -160,14 +334,27 @@ class SkillManager:
         name = tool_call.function.name
         args = json.loads(tool_call.function.arguments)
         print(f'try call skill {name}: {json.dumps(args)}')
-        if not name in self._skills:
-            raise ValueError(f'Skill {name} not found.')
-        skill = self._skills[name]
+        skill = self._get_skill(name)
         return skill.run(**args)
 
     def get_tool_calls(self):
-        tool_calls = [skill.tool_call for skill in self._skills.values()]
-        return json.dumps(tool_calls)
+        with self._lock:
+            return self._build_tool_calls()
+
+    def _build_tool_calls(self) -> str:
+        if self._tool_calls_json is None:
+            tool_calls = []
+            for name in list(self._skills):
+                try:
+                    tool_calls.append(self._get_skill(name).tool_call)
+                except (OSError, ValueError):
+                    # 已在_get_skill中报告并移除, 不影响其他Skill:
+                    pass
+            if orjson is not None:
+                self._tool_calls_json = orjson.dumps(tool_calls).decode('utf-8')
+            else:
+                self._tool_calls_json = json.dumps(tool_calls)
+        return self._tool_calls_json
 
 if __name__ == '__main__':
     import doctest